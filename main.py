@@ -1,12 +1,27 @@
+import asyncio
 import os
 import re
+import time
 import logging
-from typing import Any, Dict, List
+from functools import lru_cache
+from typing import Any, Dict, List, Tuple
+
+from xml.sax.saxutils import escape
 
 from fastapi import FastAPI, Request, Response
 from twilio.request_validator import RequestValidator
-from twilio.twiml.messaging_response import MessagingResponse
+from twilio.rest import Client as TwilioClient
 import google.generativeai as genai
+import orjson
+import redis.asyncio as aioredis
+
+# uvloop — C-реализация event loop, заметно быстрее стандартного asyncio;
+# на платформах без него (Windows) остаёмся на дефолтном цикле
+try:
+    import uvloop
+    uvloop.install()
+except ImportError:
+    pass
 
 # Настройка логирования
 logging.basicConfig(level=logging.INFO)
@@ -14,25 +29,128 @@ logger = logging.getLogger(__name__)
 
 app = FastAPI()
 
+def _parse_ttl_seconds(value: str) -> int:
+    # SDK принимает TTL только числом секунд (или timedelta), строку вроде
+    # "1h" он отвергает — разбираем суффиксы s/m/h/d сами
+    value = value.strip().lower()
+    units = {"s": 1, "m": 60, "h": 3600, "d": 86400}
+    if value and value[-1] in units:
+        return int(value[:-1]) * units[value[-1]]
+    return int(value)
+
 # Конфигурация
 GOOGLE_API_KEY = os.getenv("GOOGLE_API_KEY", "")
 TWILIO_AUTH_TOKEN = os.getenv("TWILIO_AUTH_TOKEN", "")
+# SID нужен только для стриминга ответов: без него отвечаем одним сообщением
+TWILIO_ACCOUNT_SID = os.getenv("TWILIO_ACCOUNT_SID", "")
 BUBASHVABE_SYSTEM = os.getenv(
     "BUBASHVABE_SYSTEM",
     "Ты Бубашвабе — вежливый, полезный помощник. Отвечай кратко и по делу.",
 )
 # Если переменная не задана, используем безопасный дефолт, который есть всегда
 GEMINI_MODEL = os.getenv("GEMINI_MODEL", "gemini-1.5-flash")
+GEMINI_CACHE_TTL = _parse_ttl_seconds(os.getenv("GEMINI_CACHE_TTL", "1h"))
 MAX_HISTORY = int(os.getenv("MAX_HISTORY", "10"))
+MAX_BATCH = int(os.getenv("MAX_BATCH", "8"))
+BATCH_WINDOW_MS = int(os.getenv("BATCH_WINDOW_MS", "20"))
+# Без REDIS_URL история живёт в памяти процесса (один воркер);
+# с Redis воркеры stateless и история переживает рестарт
+REDIS_URL = os.getenv("REDIS_URL", "")
+# Стриминг: хвост ответа шлём отдельными сообщениями через REST API
+MAX_STREAM_CHUNKS = int(os.getenv("MAX_STREAM_CHUNKS", "5"))
+STREAM_FLUSH_MS = int(os.getenv("STREAM_FLUSH_MS", "200"))
+_SENTENCE_END = (".", "!", "?", "…")
 
 REQUIRE_TWILIO_SIGNATURE = os.getenv("REQUIRE_TWILIO_SIGNATURE", "false").lower() in (
     "1", "true", "yes", "on"
 )
+# Потолок размера формы: легитимные вебхуки Twilio на порядки меньше
+MAX_FORM_BYTES = int(os.getenv("MAX_FORM_BYTES", str(64 * 1024)))
+# Потолок длины сообщения (~1000 токенов по эвристике 4 символа/токен)
+MAX_BODY_CHARS = int(os.getenv("MAX_BODY_CHARS", "4000"))
+# Ответы в мессенджере короткие — не даём модели генерировать тысячи токенов
+MAX_OUTPUT_TOKENS = int(os.getenv("MAX_OUTPUT_TOKENS", "300"))
+
+# Валидатор хранит только токен — создаём один раз, а не на каждый POST
+_TWILIO_VALIDATOR = RequestValidator(TWILIO_AUTH_TOKEN) if TWILIO_AUTH_TOKEN else None
+_TWILIO_CLIENT = (
+    TwilioClient(TWILIO_ACCOUNT_SID, TWILIO_AUTH_TOKEN)
+    if TWILIO_ACCOUNT_SID and TWILIO_AUTH_TOKEN
+    else None
+)
+
+class History:
+    """История диалога: только append, с редким сбросом окна.
+
+    Скользящее окно меняло префикс запроса на каждом сообщении, что сводит
+    на нет серверное кэширование промпта у Gemini. Здесь окно растёт от
+    MAX_HISTORY до 2*MAX_HISTORY со стабильным префиксом и лишь затем
+    сбрасывается до последних MAX_HISTORY записей.
+    """
+
+    __slots__ = ("_messages",)
+
+    def __init__(self) -> None:
+        self._messages: List[Dict[str, Any]] = []
+
+    def window(self) -> List[Dict[str, Any]]:
+        return list(self._messages)
+
+    def append(self, role: str, text: str) -> None:
+        # MAX_HISTORY <= 0 означает «без истории», как в исходном _trim_history
+        if MAX_HISTORY <= 0:
+            return
+        self._messages.append({"role": role, "parts": [text]})
+        if len(self._messages) >= 2 * MAX_HISTORY:
+            del self._messages[:-MAX_HISTORY]
+
+
+_memory: Dict[str, History] = {}
+# decode_responses выключен: orjson принимает bytes, декодирование лишнее
+_redis = aioredis.from_url(REDIS_URL) if REDIS_URL else None
+
+def _history_key(from_number: str) -> str:
+    return f"history:{from_number}"
 
-_memory: Dict[str, List[Dict[str, Any]]] = {}
-SENSITIVE_PATTERN = re.compile(r"\b(cvv|password|2fa|code|pin|пароль|код)\b", re.IGNORECASE)
+async def _load_history(from_number: str) -> List[Dict[str, Any]]:
+    if _redis is None:
+        history = _memory.get(from_number)
+        return history.window() if history is not None else []
+    raw = await _redis.lrange(_history_key(from_number), 0, -1)
+    return [orjson.loads(item) for item in raw]
+
+async def _append_history(from_number: str, body: str, reply_text: str) -> None:
+    # «Без истории»: иначе ltrim(key, -0, -1) оставил бы список целиком
+    if MAX_HISTORY <= 0:
+        return
+    if _redis is None:
+        history = _memory.get(from_number)
+        if history is None:
+            history = _memory[from_number] = History()
+        history.append("user", body)
+        history.append("model", reply_text)
+        return
+    key = _history_key(from_number)
+    pipe = _redis.pipeline()
+    pipe.rpush(
+        key,
+        orjson.dumps({"role": "user", "parts": [body]}),
+        orjson.dumps({"role": "model", "parts": [reply_text]}),
+    )
+    pipe.llen(key)
+    _, length = await pipe.execute()
+    # Та же схема окна, что и в History: растём до 2*MAX_HISTORY, затем сброс
+    if length >= 2 * MAX_HISTORY:
+        await _redis.ltrim(key, -MAX_HISTORY, -1)
+# Паттерн без IGNORECASE: ищем по body.casefold(), это быстрее юникодного
+# регистронезависимого сравнения внутри re и корректно для кириллицы
+SENSITIVE_PATTERN = re.compile(r"\b(cvv|password|2fa|code|pin|пароль|код)\b")
+# Наш ответ — всегда один <Message>; шаблон дешевле сборки XML-дерева
+# через MessagingResponse. Вернуть twilio.twiml, если понадобятся другие verbs.
+TWIML_TEMPLATE = '<?xml version="1.0" encoding="UTF-8"?><Response><Message>{}</Message></Response>'
 FALLBACK_MESSAGE = "Мои мозговые жуки спят (ошибка API), попробуй позже."
 SAFETY_MESSAGE = "В целях безопасности я не обрабатываю сообщения с паролями или кодами."
+TOO_LONG_MESSAGE = "Сообщение слишком длинное, сократи его, пожалуйста."
 
 # Инициализация
 if GOOGLE_API_KEY:
@@ -40,20 +158,187 @@ if GOOGLE_API_KEY:
 else:
     logger.warning("⚠️ GOOGLE_API_KEY не установлен!")
 
-def _trim_history(history: List[Dict[str, Any]], max_entries: int) -> List[Dict[str, Any]]:
-    if max_entries <= 0: return []
-    return history[-max_entries:]
+@lru_cache(maxsize=1)
+def _get_model() -> genai.GenerativeModel:
+    # Модель не зависит от запроса: конфигурация читается один раз при старте,
+    # поэтому держим единственный экземпляр вместо пересоздания на каждый вебхук.
+    # Системный промпт одинаков для всех пользователей — кэшируем его на стороне
+    # Gemini, чтобы не токенизировать и не оплачивать его на каждом вызове.
+    generation_config = genai.types.GenerationConfig(
+        max_output_tokens=MAX_OUTPUT_TOKENS,
+        temperature=0.7,
+    )
+    try:
+        cache = genai.caching.CachedContent.create(
+            model=GEMINI_MODEL,
+            system_instruction=BUBASHVABE_SYSTEM,
+            ttl=GEMINI_CACHE_TTL,
+        )
+        return genai.GenerativeModel.from_cached_content(
+            cache, generation_config=generation_config
+        )
+    except Exception as e:
+        # Промпт короче минимума для кэша или модель его не поддерживает —
+        # работаем без explicit caching
+        logger.warning(f"Context cache unavailable, using plain model: {e}")
+        return genai.GenerativeModel(
+            model_name=GEMINI_MODEL,
+            system_instruction=BUBASHVABE_SYSTEM,
+            generation_config=generation_config,
+        )
+
+async def _get_model_async() -> genai.GenerativeModel:
+    # Первое построение модели (и каждое после cache_clear) делает сетевой
+    # CachedContent.create — уносим его в поток, чтобы не блокировать loop;
+    # дальше lru_cache отдаёт готовый экземпляр без похода в поток
+    if _get_model.cache_info().currsize:
+        return _get_model()
+    return await asyncio.to_thread(_get_model)
+
+# Микробатчер: запросы, пришедшие в пределах BATCH_WINDOW_MS, уходят к Gemini
+# одной пачкой через gather — соединение и планирование амортизируются на всплеске
+_batch_queue: "asyncio.Queue[Tuple[List[Dict[str, Any]], asyncio.Future]]" = asyncio.Queue()
+
+# asyncio хранит только слабые ссылки на задачи — без сильной ссылки
+# фоновую задачу может собрать GC прямо на лету
+_background_tasks: set = set()
+
+def _spawn(coro: Any) -> None:
+    task = asyncio.create_task(coro)
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+async def _dispatch_batch(batch: List[Tuple[List[Dict[str, Any]], asyncio.Future]]) -> None:
+    try:
+        model = await _get_model_async()
+        results = await asyncio.gather(
+            *(model.generate_content_async(contents) for contents, _ in batch),
+            return_exceptions=True,
+        )
+    except Exception as e:
+        # Вебхуки ждут свои футуры без таймаута: падение вне gather
+        # (например, в _get_model_async) не должно оставить их висеть
+        for _, future in batch:
+            if not future.done():
+                future.set_exception(e)
+        return
+    for (_, future), result in zip(batch, results):
+        if future.cancelled():
+            continue
+        if isinstance(result, BaseException):
+            future.set_exception(result)
+        else:
+            future.set_result(result)
+
+async def _batch_worker() -> None:
+    loop = asyncio.get_running_loop()
+    while True:
+        batch = [await _batch_queue.get()]
+        deadline = loop.time() + BATCH_WINDOW_MS / 1000
+        while len(batch) < MAX_BATCH:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(await asyncio.wait_for(_batch_queue.get(), timeout))
+            except asyncio.TimeoutError:
+                break
+
+        # Пачка уходит отдельной задачей: цикл сбора продолжает принимать
+        # запросы, не дожидаясь самого медленного вызова в полёте
+        _spawn(_dispatch_batch(batch))
+
+async def _generate(contents: List[Dict[str, Any]]) -> Any:
+    future = asyncio.get_running_loop().create_future()
+    await _batch_queue.put((contents, future))
+    return await future
+
+@app.on_event("startup")
+async def _start_batch_worker() -> None:
+    _spawn(_batch_worker())
+
+# Замки на пользователя: два сообщения подряд от одного номера иначе
+# читают одну и ту же историю и затирают ответы друг друга при записи
+_locks: Dict[str, asyncio.Lock] = {}
+_lock_seen: Dict[str, float] = {}
+_MAX_LOCKS = 10_000
+_LOCK_TTL_SECONDS = 3600
 
-def _validate_twilio_signature(request: Request, form_data: Dict[str, str]) -> bool:
-    signature = request.headers.get("X-Twilio-Signature", "")
-    if not signature or not TWILIO_AUTH_TOKEN: return False
-    validator = RequestValidator(TWILIO_AUTH_TOKEN)
-    return validator.validate(str(request.url), form_data, signature)
+def _user_lock(from_number: str) -> asyncio.Lock:
+    now = time.monotonic()
+    lock = _locks.get(from_number)
+    if lock is None:
+        if len(_locks) >= _MAX_LOCKS:
+            # Сбрасываем только давно не использовавшиеся замки: проверка
+            # locked() ненадёжна — между release() и пробуждением ожидающего
+            # замок на мгновение «свободен», хотя очередь к нему не пуста.
+            # У любого ожидающего last-seen свежий: он прошёл через эту
+            # функцию прямо перед acquire()
+            cutoff = now - _LOCK_TTL_SECONDS
+            for key in [k for k, seen in _lock_seen.items() if seen < cutoff]:
+                del _locks[key]
+                del _lock_seen[key]
+        lock = _locks[from_number] = asyncio.Lock()
+    _lock_seen[from_number] = now
+    return lock
+
+def _form_str(form: Any, key: str, default: str = "") -> str:
+    # Multipart-запрос может прислать поле файлом (UploadFile), а не строкой —
+    # такое значение считаем отсутствующим, чтобы не падать на .strip()
+    value = form.get(key, default)
+    return value if isinstance(value, str) else default
+
+def _validate_twilio_signature(url: str, form_data: Dict[str, str], signature: str) -> bool:
+    if not signature or _TWILIO_VALIDATOR is None: return False
+    return _TWILIO_VALIDATOR.validate(url, form_data, signature)
+
+async def _send_followup(user_number: str, bot_number: str, text: str) -> None:
+    # REST-клиент Twilio синхронный — отправляем из потока
+    await asyncio.to_thread(
+        _TWILIO_CLIENT.messages.create, body=text, from_=bot_number, to=user_number
+    )
+
+async def _finish_stream(
+    chunks: Any,
+    first_text: str,
+    user_number: str,
+    bot_number: str,
+    body: str,
+    lock: asyncio.Lock,
+) -> None:
+    """Дочитывает стрим после раннего ответа вебхука.
+
+    Хвост уходит отдельными сообщениями через REST API (не больше
+    MAX_STREAM_CHUNKS всего), история обновляется полным текстом.
+    Замок пользователя передан нам и снимается здесь.
+    """
+    parts = [first_text]
+    buffer = ""
+    sent = 1
+    try:
+        async for chunk in chunks:
+            text = chunk.text or ""
+            if not text:
+                continue
+            parts.append(text)
+            buffer += text
+            if sent < MAX_STREAM_CHUNKS - 1 and buffer.rstrip().endswith(_SENTENCE_END):
+                await _send_followup(user_number, bot_number, buffer.strip())
+                sent += 1
+                buffer = ""
+        if buffer.strip():
+            await _send_followup(user_number, bot_number, buffer.strip())
+        await _append_history(user_number, body, "".join(parts).strip())
+    except Exception as e:
+        logger.error(f"Streaming error: {e}")
+    finally:
+        lock.release()
 
 def _build_twiml(message: str) -> Response:
-    response = MessagingResponse()
-    response.message(message)
-    return Response(content=str(response), media_type="application/xml")
+    return Response(
+        content=TWIML_TEMPLATE.format(escape(message)),
+        media_type="application/xml",
+    )
 
 @app.get("/health")
 def health():
@@ -61,47 +346,116 @@ def health():
 
 @app.post("/whatsapp")
 async def whatsapp_webhook(request: Request) -> Response:
+    # Отсекаем заведомо плохие запросы до парсинга формы: без подписи
+    # (если она обязательна) и с чрезмерным телом — чтобы нельзя было
+    # навязать нам работу по разбору произвольно больших payload'ов
+    if REQUIRE_TWILIO_SIGNATURE and not request.headers.get("X-Twilio-Signature"):
+        return Response(content="Forbidden", status_code=403)
+
+    # Twilio всегда присылает Content-Length; без него (chunked) размер тела
+    # до чтения не ограничить — отклоняем. Заниженное значение подделать
+    # нельзя: HTTP-парсер сервера обрывает тело, выходящее за заявленную длину
+    content_length = request.headers.get("Content-Length")
+    if content_length is None or not content_length.isdigit():
+        return Response(content="Length Required", status_code=411)
+    if int(content_length) > MAX_FORM_BYTES:
+        return Response(content="Payload Too Large", status_code=413)
+
     form = await request.form()
-    form_data = {key: str(value) for key, value in form.items()}
-    from_number = form_data.get("From", "unknown")
-    body = form_data.get("Body", "").strip()
+    from_number = _form_str(form, "From", "unknown")
+    bot_number = _form_str(form, "To")
+    body = _form_str(form, "Body").strip()
 
     logger.info(f"Incoming message from {from_number}: {body}")
 
     if REQUIRE_TWILIO_SIGNATURE:
-        if not _validate_twilio_signature(request, form_data):
+        # URL и dict нужны только валидатору — материализуем их лишь на этой ветке
+        url = str(request.url)
+        signature = request.headers.get("X-Twilio-Signature", "")
+        # Файловые части (UploadFile) выкидываем: валидатор конкатенирует
+        # значения со строкой и упал бы на них, а в подписи Twilio их нет
+        form_data = {k: v for k, v in form.items() if isinstance(v, str)}
+        # Сортировка полей и HMAC-SHA1 — синхронная CPU-работа; уносим её
+        # в поток, чтобы не задерживать другие корутины на больших формах
+        ok = await asyncio.to_thread(_validate_twilio_signature, url, form_data, signature)
+        if not ok:
             logger.warning("Invalid Twilio Signature")
             return Response(content="Forbidden", status_code=403)
 
     if not body:
         return _build_twiml("Привет! Я слушаю.")
 
-    if SENSITIVE_PATTERN.search(body):
+    if len(body) > MAX_BODY_CHARS:
+        # Отказываем, а не обрезаем: молча усечённый вопрос даёт ответ
+        # не на то, что спрашивали
+        return _build_twiml(TOO_LONG_MESSAGE)
+
+    if SENSITIVE_PATTERN.search(body.casefold()):
         return _build_twiml(SAFETY_MESSAGE)
 
+    # Сообщения одного пользователя сериализуем: параллельные вызовы
+    # с одинаковой историей тратят токены впустую и теряют ответы.
+    # Замок берём явно: при стриминге его снимает фоновая задача
+    lock = _user_lock(from_number)
+    await lock.acquire()
+    lock_passed = False
     try:
-        current_history = list(_memory.get(from_number, []))
-        
-        # Явная инициализация модели внутри запроса для надежности
-        model = genai.GenerativeModel(
-            model_name=GEMINI_MODEL,
-            system_instruction=BUBASHVABE_SYSTEM
-        )
-        
-        chat = model.start_chat(history=current_history)
-        result = chat.send_message(body)
-        reply_text = result.text.strip()
-        
-        # Обновляем память только при успехе
-        current_history.append({"role": "user", "parts": [body]})
-        current_history.append({"role": "model", "parts": [reply_text]})
-        _memory[from_number] = _trim_history(current_history, MAX_HISTORY)
+        current_history = await _load_history(from_number)
+
+        # Историей управляем сами, поэтому ChatSession не нужен —
+        # отправляем контекст напрямую одним вызовом
+        contents = current_history + [{"role": "user", "parts": [body]}]
+
+        if _TWILIO_CLIENT is None or not bot_number:
+            # Без REST-клиента стримить некуда — отвечаем одним сообщением
+            result = await _generate(contents)
+            reply_text = result.text.strip()
 
+            # Обновляем память только при успехе
+            await _append_history(from_number, body, reply_text)
+            return _build_twiml(reply_text)
+
+        # Стриминг: отдаём первое предложение сразу в ответе вебхука,
+        # остальное дошлём через REST — воспринимаемая задержка падает
+        # до времени первого предложения
+        model = await _get_model_async()
+        stream = await model.generate_content_async(contents, stream=True)
+        chunks = stream.__aiter__()
+        loop = asyncio.get_running_loop()
+        start = loop.time()
+        first_buffer = ""
+        exhausted = False
+        while True:
+            try:
+                chunk = await chunks.__anext__()
+            except StopAsyncIteration:
+                exhausted = True
+                break
+            first_buffer += chunk.text or ""
+            if first_buffer.rstrip().endswith(_SENTENCE_END):
+                break
+            if (loop.time() - start) * 1000 >= STREAM_FLUSH_MS:
+                break
+
+        reply_text = first_buffer.strip()
+        if exhausted:
+            await _append_history(from_number, body, reply_text)
+            return _build_twiml(reply_text)
+
+        # _spawn держит сильную ссылку: потерянная задача не сняла бы
+        # переданный ей замок пользователя
+        _spawn(_finish_stream(chunks, first_buffer, from_number, bot_number, body, lock))
+        lock_passed = True
         return _build_twiml(reply_text)
 
     except Exception as e:
         logger.error(f"Gemini Error: {e}")
-        
+
+        # Истёкший TTL контекст-кэша лечится пересозданием модели на
+        # следующем запросе
+        if "cachedcontent" in str(e).lower().replace(" ", ""):
+            _get_model.cache_clear()
+
         # --- DEBUG: Если ошибка 404/Not Found, выводим список доступных моделей ---
         if "404" in str(e) or "not found" in str(e).lower():
             try:
@@ -114,3 +468,7 @@ async def whatsapp_webhook(request: Request) -> Response:
         # -------------------------------------------------------------------------
 
         return _build_twiml(FALLBACK_MESSAGE)
+
+    finally:
+        if not lock_passed:
+            lock.release()